@@ -2,21 +2,122 @@
 
 """Batch render LaTeX files to cropped SVG images."""
 
-__all__ = ["LatexFile", "LatexClipping", "LatexError"]
+__all__ = [
+    "LatexFile",
+    "LatexClipping",
+    "LatexClippingBatch",
+    "LatexEngine",
+    "LatexError",
+    "render_files_parallel",
+]
 __version__ = "0.1.3"
 __author__ = "Justin Yao Du"
 
 import argparse
-import base64
-import html
+import array
+import atexit
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import itertools
+import json
+import os
 from pathlib import Path
 import re
-import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
-import textwrap
+import uuid
+
+# Use the SIMD-accelerated base64 implementation when available; it is
+# a drop-in replacement for the standard library module.
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+
+# Absolute paths of the external tools, resolved once at import time.
+# This skips PATH resolution on every spawn, and a missing tool fails
+# with a clean error from _run_command instead of ENOENT after fork.
+_latex_path = shutil.which("latex") or "latex"
+_dvisvgm_path = shutil.which("dvisvgm") or "dvisvgm"
+_pdflatex_path = shutil.which("pdflatex") or "pdflatex"
+_pdfcrop_path = shutil.which("pdfcrop") or "pdfcrop"
+_pdftocairo_path = shutil.which("pdftocairo") or "pdftocairo"
+_pdfinfo_path = shutil.which("pdfinfo") or "pdfinfo"
+_inkscape_path = shutil.which("inkscape") or "inkscape"
+
+# Prefer latex + dvisvgm, which crops and converts every page with a
+# single dvisvgm invocation straight from the DVI. Next best is
+# pdflatex with the poppler tools; the last resort is pdflatex with a
+# single inkscape shell session.
+_use_dvisvgm = all(map(shutil.which, ("latex", "dvisvgm")))
+_use_poppler = all(map(shutil.which, ("pdfcrop", "pdftocairo", "pdfinfo")))
+
+# Tag for the converter in use. Converters disagree on the units of
+# their reported dimensions, so cached ex measurements from one must
+# not be combined with page dimensions from another.
+if _use_dvisvgm:
+    _converter_name = "dvisvgm"
+elif _use_poppler:
+    _converter_name = "poppler"
+else:
+    _converter_name = "inkscape"
+
+# Directory holding cached render results, created lazily on first
+# write. Overridable through the LATEXCLIPPINGS_CACHE environment
+# variable.
+_cache_dir = Path(os.environ.get(
+        "LATEXCLIPPINGS_CACHE", "~/.cache/latexclippings")).expanduser()
+
+# Directory holding cached ex measurements, keyed by preamble hash.
+_ex_cache_dir = _cache_dir / "ex"
+
+# Directory holding precompiled format files (see LatexEngine).
+_format_cache_dir = _cache_dir / "fmt"
+
+# Persistent TEXMFVAR for the engine subprocesses, so the font map and
+# pk caches survive across renders and across processes instead of
+# being repopulated every run.
+_texmf_var_dir = _cache_dir / "texmf"
+
+# Per-process temporary root, created lazily by _render_dir.
+_temp_root = None
+
+# In-process cache of clipping fields by cache key, so repeated hits
+# for the same clipping skip even the cache file read.
+_memory_cache = {}
+
+# Precompiled patterns for reading geometry out of rendered SVGs,
+# hoisted to module scope so per-page parsing skips the re module's
+# pattern cache lookup. Converters disagree on attribute quoting
+# (dvisvgm uses single quotes), so both styles are accepted.
+_svg_width_regex = re.compile(rb'<svg[^>]*\swidth=["\']([0-9.]+)')
+_svg_height_regex = re.compile(rb'<svg[^>]*\sheight=["\']([0-9.]+)')
+_svg_view_box_regex = re.compile(rb'<svg[^>]*\sviewBox=["\']([^"\']*)')
+_marker_element_regex = re.compile(b"".join([
+    rb"<(?:rect|path)\b[^<>]*",
+    rb"(?:#f00\b|#ff0000|rgb\(\s*100%\s*,\s*0%\s*,\s*0%\s*\)|\bred\b)",
+    rb"[^<>]*>",
+]), re.IGNORECASE)
+_y_attr_regex = re.compile(rb'\by=["\']([0-9.eE+-]+)')
+_height_attr_regex = re.compile(rb'\bheight=["\']([0-9.eE+-]+)')
+_outline_attr_regex = re.compile(rb'\bd=["\']([^"\']*)')
+_number_regex = re.compile(rb"-?[0-9.]+(?:[eE][+-]?[0-9]+)?")
+
+# Zero-size red rule typeset on the baseline of each clipping. Locating
+# it in the rendered SVG gives the depth directly, without typesetting
+# and converting a second page per clipping. The negative kern cancels
+# the rule width, and \smash hides its (tiny) height.
+_baseline_marker = r"\rlap{\smash{\color{red}\rule{0.1pt}{0.1pt}}\kern-0.1pt}"
+
+# Template for LatexClipping.css, built once at module scope. The :g
+# conversions drop trailing zeros, shrinking the emitted HTML.
+_css_template = ("display:inline-block;width:{:g}ex;height:{:g}ex;"
+        "vertical-align:{:g}ex;")
 
 
 class LatexFile:
@@ -24,176 +125,480 @@ class LatexFile:
     and additional pages used for internal measurements.
     """
 
-    default_preamble = textwrap.dedent(r"""
-        \documentclass{article}
-        \pagestyle{empty}""")
+    default_preamble = "\n".join([
+        "",
+        r"\documentclass{article}",
+        r"\pagestyle{empty}",
+    ])
 
-    def __init__(self, clippings, preamble=default_preamble):
+    def __init__(self, clippings, preamble=default_preamble,
+            force_refresh=False, measure_depth=True):
         # Remove up to one trailing newline.
         clippings = [re.sub(r"[\n]$", "", c) for c in clippings]
 
+        # When clippings will not be baseline-aligned, skipping the
+        # depth measurement halves the pages to typeset and convert.
+        # Depths are then reported as zero.
+        self._measure_depth = measure_depth
+
         self.clippings = [LatexClipping(c) for c in clippings]
-        self._init_chunks(preamble, clippings)
 
-    def _init_chunks(self, preamble, clippings):
+        # Identical clippings only need to be rendered once; later
+        # occurrences point at the first and copy its results.
+        first_seen = {}
+        for clipping in self.clippings:
+            clipping._cache_key = _clipping_cache_key(preamble, clipping.latex)
+            if not force_refresh:
+                _load_cached_clipping(clipping)
+
+            clipping._duplicate_of = first_seen.get(clipping.latex)
+            if clipping._duplicate_of is None:
+                first_seen[clipping.latex] = clipping
+
+        # The ex measurement depends only on the preamble (and on the
+        # converter's units), so it can be reused whenever the
+        # preamble is unchanged.
+        preamble_hash = hashlib.blake2b(
+                preamble.encode("utf-8"), digest_size=16).hexdigest()
+        self._ex_cache_key = preamble_hash + "-" + _converter_name
+        self._one_ex = None
+        if not force_refresh:
+            try:
+                self._one_ex = __class__._cached_one_ex(self._ex_cache_key)
+            except (OSError, ValueError):
+                pass
+
+        # Set by LatexEngine when rendering against a precompiled
+        # format file.
+        self._engine = None
+
+        self._init_chunks(preamble)
+
+    @classmethod
+    def render_many(cls, clippings, preamble=default_preamble,
+            force_refresh=False, measure_depth=True):
+        """Render several clippings with a single pdflatex invocation,
+        returning the resulting LatexClippings. This amortizes the
+        fixed startup cost of pdflatex across all of the clippings.
+
+        Pass measure_depth=False to skip the baseline measurement when
+        the clippings will not be inlined with text; depths are then
+        zero, and css() produces vertical-align: 0ex.
+        """
+
+        latex_file = cls(clippings, preamble, force_refresh, measure_depth)
+        latex_file.render()
+        return latex_file.clippings
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def _cached_one_ex(ex_cache_key):
+        """Load the cached ex measurement for a preamble. Raise OSError
+        if no measurement has been cached.
+        """
+
+        return float((_ex_cache_dir / ex_cache_key).read_text())
+
+    def _init_chunks(self, preamble):
         self.chunks = []
 
+        if self._engine is None:
+            preamble_lines = preamble.split("\n")
+        else:
+            # The preamble is baked into the precompiled format, so
+            # the document skips straight to loading the color package.
+            preamble_lines = []
+
         self.chunks.append(_LatexChunk(
             "preamble",
             [
-                *preamble.split("\n"),
-                r"\usepackage{trimclip}",
+                *preamble_lines,
+                r"\usepackage{color}",
                 r"\begin{document}",
             ]
         ))
 
-        # Lowercase x, for measuring an ex with the current font.
-        self.chunks.append(_LatexChunk("lowercase x", ["x"], True))
-
-        for clipping, clipping_index in zip(clippings, itertools.count()):
-            # Render clipping normally.
+        # Lowercase x, for measuring an ex with the current font. Not
+        # needed when the measurement was cached for this preamble.
+        page = 0
+        if self._one_ex is None:
+            self.chunks.append(_LatexChunk("lowercase x", ["x"], True))
+            page = 1
+
+        for clipping_index, clipping in enumerate(self.clippings):
+            # Cached clippings are already fully rendered, and
+            # duplicates copy their results from the first occurrence,
+            # so neither appears in the generated document.
+            if clipping.cached or clipping._duplicate_of is not None:
+                continue
+
+            # Render clipping normally, with the baseline marker in
+            # front when the depth will be measured. Wrap the
+            # pre-split source lines instead of splitting the wrapped
+            # source again.
+            prefix = _baseline_marker if self._measure_depth else ""
+            lines = list(clipping._lines)
+            lines[0] = prefix + r"\begingroup{}" + lines[0]
+            lines[-1] += r"\endgroup"
             self.chunks.append(_LatexChunk(
                 f"clipping {clipping_index}",
-                (r"\begingroup{}" + clipping + r"\endgroup").split("\n"),
-                True,
-                clipping_index
-            ))
-
-            # Render portion of clipping below baseline to measure depth.
-            self.chunks.append(_LatexChunk(
-                f"clipping {clipping_index} (in clipbox)",
-                (
-                    r"\begin{clipbox}{0 0 0 {\height}}\vbox{\begingroup{}"
-                    + clipping
-                    + r"\endgroup}\end{clipbox}"
-                ).split("\n"),
+                lines,
                 True,
                 clipping_index
             ))
+            page += 1
+            clipping._page = page
 
+        self._page_count = page
         self.chunks.append(_LatexChunk("document end", [r"\end{document}"]))
 
     def __str__(self):
-        return "\n".join(str(chunk) for chunk in self.chunks)
+        # Join the chunk lines directly, rather than stringifying each
+        # chunk and joining again, to avoid a second pass over the
+        # whole document.
+        return "\n".join(itertools.chain.from_iterable(
+                chunk.lines for chunk in self.chunks))
+
+    def __bytes__(self):
+        # Encode line by line, avoiding a second document-sized
+        # allocation for encoding the joined str.
+        return b"\n".join(
+                line.encode("utf-8") for line in itertools.chain
+                .from_iterable(chunk.lines for chunk in self.chunks))
 
     def render(self):
         """Render each clipping as a SVG."""
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_dir = Path(temp_dir)
-            pdf_path = self._pdflatex(temp_dir)
-            self._load_svgs_from_pdf(pdf_path)
+        # Every clipping was found in the cache; nothing to render.
+        if all(clipping.cached for clipping in self.clippings):
+            return
 
-    def _pdflatex(self, working_dir):
-        """Convert this LaTeX document to a PDF. Raise LatexError if
-        pdflatex is unsuccessful.
+        temp_dir = _render_dir()
+        try:
+            if _use_dvisvgm:
+                dvi_path = self._latex(temp_dir)
+                pages = _dvisvgm_pages(dvi_path, self._page_count)
+            else:
+                pdf_path = self._pdflatex(temp_dir)
+                pages = _extract_all_pages(pdf_path, self._page_count)
+            self._load_svgs(pages)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _pdflatex(self, working_dir, draft=False):
+        """Convert this LaTeX document to a PDF with pdflatex."""
+
+        return self._typeset(working_dir, _pdflatex_path, ".pdf", draft)
+
+    def _latex(self, working_dir, draft=False):
+        """Convert this LaTeX document to a DVI with latex."""
+
+        return self._typeset(working_dir, _latex_path, ".dvi", draft)
+
+    def _typeset(self, working_dir, engine_path, output_suffix,
+            draft=False):
+        """Typeset this document with a TeX engine and return the path
+        of the output file. Raise LatexError if the engine reports an
+        error in the document.
+
+        With draft=True, the engine still typesets the document and
+        writes the log, but skips emitting the output file; useful for
+        callers that only need error checking.
         """
 
-        tex_file = working_dir / "clippings.tex"
-        with open(tex_file, "w") as f:
-            f.write(str(self))
-
-        pdflatex_process = _run_command(
-            [
-                "pdflatex",
-                "-halt-on-error",
-                shlex.quote(str(tex_file))
-            ],
+        argv = [
+            engine_path,
+            "-interaction=batchmode",
+            "-halt-on-error",
+            "-no-shell-escape",
+            "-jobname=clippings",
+        ]
+        if draft:
+            argv.insert(1, "-draftmode")
+
+        # Point the engine's variable tree at a persistent directory,
+        # so its font and map caches are warm on repeat renders.
+        _texmf_var_dir.mkdir(parents=True, exist_ok=True)
+        env = dict(os.environ)
+        env["TEXMFVAR"] = str(_texmf_var_dir)
+
+        if self._engine is not None:
+            argv.insert(1, "-fmt=" + self._engine._format_name)
+            # Let kpathsea find the cached format file; the trailing
+            # separator keeps the default search path as a fallback.
+            env["TEXFORMATS"] = str(_format_cache_dir) + os.pathsep
+
+        # Write the document next to the engine's other working files.
+        # It must be a real file: in batch mode the engine never reads
+        # past the first line of terminal input, so a document piped
+        # through standard input aborts without typesetting anything.
+        # The working directory lives on tmpfs when available, so this
+        # write does not touch the disk.
+        (working_dir / "clippings.tex").write_bytes(bytes(self))
+        argv.append("clippings.tex")
+
+        # Batch mode suppresses terminal output, so the log is read
+        # from the .log file instead.
+        engine_process = _run_command(
+            argv,
             cwd=working_dir,
-            text=True,
             capture_output=True,
+            env=env,
         )
 
-        self._parse_pdflatex_log(pdflatex_process.stdout)
+        try:
+            log = (working_dir / "clippings.log").read_bytes()
+        except OSError:
+            # The engine failed before opening its log file.
+            log = engine_process.stdout
+
+        self._parse_pdflatex_log(log)
 
         try:
-            pdflatex_process.check_returncode()
+            engine_process.check_returncode()
         except subprocess.CalledProcessError as e:
-            raise ValueError(pdflatex_process.stdout) from e
+            raise ValueError(log.decode("utf-8", errors="replace")) from e
 
-        return working_dir / "clippings.pdf"
+        return working_dir / ("clippings" + output_suffix)
 
-    _pdflatex_error_regex = "".join([
-        r"(?m)",
-        r"^! (?P<error_msg>.*)[\n]",
-        r"(?P<inserted_text>(?:.*[\n])+)?",
-        r"^l\.(?P<line_num>[0-9]+) (?P<line_contents>.*)$",
-    ])
+    _pdflatex_error_regex = re.compile(b"".join([
+        rb"^! (?P<error_msg>.*)[\n]",
+        rb"(?P<inserted_text>(?:.*[\n])+)?",
+        rb"^l\.(?P<line_num>[0-9]+) ?(?P<line_contents>.*)$",
+    ]), re.MULTILINE)
 
     def _parse_pdflatex_log(self, log):
-        """Parse the pdflatex log, assigning log sections to the
-        corresponding LatexClippings. Raise LatexError for any error
-        messages encountered.
+        """Parse the pdflatex log (as bytes), assigning log sections to
+        the corresponding LatexClippings. Raise LatexError for any
+        error messages encountered.
+
+        Keeping the log as bytes avoids decoding the whole file on the
+        (usual) success path; each clipping decodes its own section
+        lazily on first access.
         """
 
-        log_sections = log.split(_LatexChunk.CHUNK_HEADER + "\n")
+        log_sections = log.split(
+                (_LatexChunk.CHUNK_HEADER + "\n").encode("ascii"))
 
         # Skip the initialization output (before start of preamble).
         log_sections = log_sections[1:]
 
-        for _ in zip(self.chunks, log_sections, itertools.count()):
-            chunk, log_section, chunk_index = _
+        # Number of lines preceding each chunk, computed once instead
+        # of summing over all prior chunks per iteration.
+        chunk_start_lines = list(itertools.accumulate(
+                itertools.chain([0], (len(c) for c in self.chunks))))
+
+        for chunk_index, (chunk, log_section) in enumerate(
+                zip(self.chunks, log_sections)):
             clipping = None
 
             if chunk.clipping_index is not None:
                 clipping = self.clippings[chunk.clipping_index]
 
-                # Only assign the log from rendering the full (not
-                # cropped) clipping.
-                if clipping.log is None:
-                    clipping.log = log_section
+                # Only assign the first log section produced for this
+                # clipping.
+                if clipping._log_bytes is None:
+                    clipping._log_bytes = log_section
 
-            match = re.search(__class__._pdflatex_error_regex, log_section)
+            match = __class__._pdflatex_error_regex.search(log_section)
             if match:
                 groupdict = match.groupdict()
 
                 # Get zero-indexed line numbers.
                 file_line_num = int(groupdict['line_num']) - 1
-                chunk_line_num = (file_line_num
-                        - sum(len(c) for c in self.chunks[:chunk_index]))
+                chunk_line_num = file_line_num - chunk_start_lines[chunk_index]
 
-                context_lines = []
                 context_dist = 2
-                for i in range(
-                        max(chunk.source_start, chunk_line_num - context_dist),
-                        min(len(chunk), chunk_line_num + context_dist + 1)):
-                    if i == chunk_line_num:
-                        prefix = "> "
-                    else:
-                        prefix = "  "
-                    context_lines.append(prefix + chunk.lines[i])
-                context = "\n".join(context_lines)
+                start = max(chunk.source_start,
+                        chunk_line_num - context_dist)
+                end = min(len(chunk), chunk_line_num + context_dist + 1)
+                context = "\n".join(
+                        ("> " if start + i == chunk_line_num else "  ") + line
+                        for i, line in enumerate(chunk.lines[start:end]))
 
                 # Add 1 to make line number one-indexed.
                 display_line_num = chunk_line_num - chunk.source_start + 1
 
+                error_msg = groupdict['error_msg'].decode(
+                        "utf-8", errors="replace")
                 raise LatexError(chunk.clipping_index, chunk.name,
-                        display_line_num, groupdict['error_msg'], context)
+                        display_line_num, error_msg, context)
+
+    def _load_svgs(self, pages):
+        """Load the rendered page _SVGs into the LatexClippings."""
 
-    def _load_svgs_from_pdf(self, pdf_path):
-        """Load SVGs from the rendered PDF into the LatexClippings."""
+        one_ex = self._one_ex
+        if one_ex is None:
+            one_ex = pages[0].height
+            _store_one_ex(self._ex_cache_key, one_ex)
 
-        one_ex = _cropped_pdf_page(pdf_path, 1).height
+        for clipping in self.clippings:
+            if clipping.cached or clipping._duplicate_of is not None:
+                continue
 
-        for clipping, index in zip(self.clippings, itertools.count(1)):
-            image_full = _cropped_pdf_page(pdf_path, 2 * index)
-            image_below_baseline = _cropped_pdf_page(pdf_path, 2 * index + 1)
+            image_full = pages[clipping._page - 1]
 
-            clipping.svg = image_full.source
             clipping.width = image_full.width / one_ex
             clipping.height = image_full.height / one_ex
-            clipping.depth = image_below_baseline.height / one_ex
+
+            if self._measure_depth:
+                depth, svg = _marker_depth(image_full)
+                clipping.depth = depth / one_ex
+                clipping.svg = svg
+
+                # Only fully measured renders are cached, so cache
+                # entries always include a real depth.
+                _store_cached_clipping(clipping)
+            else:
+                clipping.depth = 0.0
+                clipping.svg = image_full.source
+
+        # Copy results from the first occurrence to any duplicates.
+        for clipping in self.clippings:
+            canonical = clipping._duplicate_of
+            if canonical is not None:
+                clipping.svg = canonical.svg
+                clipping.width = canonical.width
+                clipping.height = canonical.height
+                clipping.depth = canonical.depth
+                clipping._log_bytes = canonical._log_bytes
+
+
+class LatexEngine:
+    """Render repeatedly with the same preamble, using a precompiled
+    format file so the document class and packages are loaded once
+    instead of on every render.
+
+    The format is dumped the first time it is needed and cached on
+    disk, keyed by the preamble and the TeX engine, so later processes
+    reuse it as well. If the preamble cannot be dumped (some packages
+    only work when loaded normally), rendering falls back to the plain
+    per-render preamble.
+    """
+
+    def __init__(self, preamble=LatexFile.default_preamble):
+        self.preamble = preamble
+
+        self._engine_path = _latex_path if _use_dvisvgm else _pdflatex_path
+
+        # Key the cached format by the preamble and the engine version;
+        # engines refuse to load a format dumped by a different
+        # version, so a stale key would hard-fail every render after a
+        # TeX upgrade.
+        key_hash = hashlib.blake2b(
+                preamble.encode("utf-8") + b"\0"
+                    + _engine_version(self._engine_path),
+                digest_size=16).hexdigest()
+        self._format_name = key_hash + "-" + Path(self._engine_path).name
+        self._format_file = _format_cache_dir / (self._format_name + ".fmt")
+
+    def render_many(self, clippings, force_refresh=False,
+            measure_depth=True):
+        """Render several clippings against the precompiled preamble;
+        see LatexFile.render_many.
+        """
+
+        latex_file = LatexFile(
+                clippings, self.preamble, force_refresh, measure_depth)
+        if self._ensure_format():
+            latex_file._engine = self
+            # Rebuild the chunks without the preamble source, which is
+            # already baked into the format file.
+            latex_file._init_chunks(self.preamble)
+        latex_file.render()
+        return latex_file.clippings
+
+    def _ensure_format(self):
+        """Dump the preamble to a cached format file, unless one
+        already exists. Return whether the format is usable.
+        """
+
+        if self._format_file.exists():
+            return True
+
+        _format_cache_dir.mkdir(parents=True, exist_ok=True)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir = Path(temp_dir)
+
+            # The preamble must be a real file: in batch mode the
+            # engine never reads terminal input past the first line, so
+            # a preamble piped on standard input would abort the dump.
+            (temp_dir / "preamble.tex").write_text(
+                    self.preamble + "\n\\dump\n")
+
+            dump_process = _run_command(
+                [
+                    self._engine_path,
+                    "-ini",
+                    "-interaction=batchmode",
+                    "-halt-on-error",
+                    "-no-shell-escape",
+                    f"-jobname={self._format_name}",
+                    "&" + Path(self._engine_path).name,
+                    "preamble.tex",
+                ],
+                cwd=temp_dir,
+                capture_output=True,
+            )
+            if dump_process.returncode != 0:
+                return False
+
+            # Stage next to the final name before the rename, so the
+            # publish stays atomic even when the temporary directory is
+            # on a different filesystem than the cache.
+            temp_file = self._format_file.with_suffix(".tmp")
+            shutil.copyfile(
+                    temp_dir / (self._format_name + ".fmt"), temp_file)
+            os.replace(temp_file, self._format_file)
+
+        return True
 
 
 class LatexClipping:
     """Represent a rendered LaTeX clipping."""
 
+    # Avoid a per-instance attribute dict; large batches create tens
+    # of thousands of these.
+    __slots__ = (
+        "latex",
+        "_lines",
+        "_log",
+        "_log_bytes",
+        "width",
+        "height",
+        "depth",
+        "svg",
+        "cached",
+        "_cache_key",
+        "_duplicate_of",
+        "_page",
+        "_css",
+        "_embeddable",
+    )
+
+    # Escapes HTML attribute values in one C-level pass, including the
+    # newline encoding previously done with a separate replace.
+    _escape_table = str.maketrans({
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "'": "&#x27;",
+        "\n": "&#13;&#10;",
+    })
+
     def __init__(self, latex):
         # LaTeX source.
         self.latex = latex
 
-        # pdflatex log from generating this clipping.
-        self.log = None
+        # Source lines, split once and reused when building chunks.
+        self._lines = latex.split("\n")
+
+        # pdflatex log from generating this clipping, kept as bytes
+        # and decoded lazily through the log property.
+        self._log = None
+        self._log_bytes = None
 
         # Image measurements in ex. Depth is the height of the portion
         # of the image below the baseline.
@@ -201,37 +606,118 @@ class LatexClipping:
         self.height = None
         self.depth = None
 
-        # SVG source.
+        # SVG source, as bytes.
         self.svg = None
 
+        # Whether this clipping was loaded from the on-disk cache.
+        self.cached = False
+
+        # Memoized css() and embeddable() results; clippings are
+        # immutable once rendered.
+        self._css = None
+        self._embeddable = None
+
+    @property
+    def log(self):
+        """pdflatex log from generating this clipping, decoded from
+        the captured bytes on first access.
+        """
+
+        if self._log is None and self._log_bytes is not None:
+            self._log = self._log_bytes.decode("utf-8", errors="replace")
+        return self._log
+
+    @log.setter
+    def log(self, value):
+        self._log = value
+
+    @property
+    def svg_text(self):
+        """The SVG source decoded to str, for callers needing text."""
+
+        return self.svg.decode("utf-8")
+
     def css(self):
         """Return CSS styles which can be applied to an inline <img> tag
         containing this clipping's SVG. These rules will align the
         baseline and scale the image to match the surrounding text.
+        The result is computed once and reused on later calls.
         """
 
-        return " ".join([
-            "display: inline-block;",
-            f"width: {self.width:.5f}ex;",
-            f"height: {self.height:.5f}ex;",
-            f"vertical-align: {-self.depth:.5f}ex;"
-        ])
+        if self._css is None:
+            # Adding 0.0 turns a negated zero depth back into positive
+            # zero, so :g prints "0" rather than "-0".
+            self._css = _css_template.format(
+                    self.width, self.height, -self.depth + 0.0)
+        return self._css
 
     def embeddable(self):
         """Return a string representing a HTML <img> tag, which contains
-        the base64-encoded SVG and CSS rules for inline display.
+        the base64-encoded SVG and CSS rules for inline display. The
+        result is computed once and reused on later calls.
         """
 
-        svg_without_prolog = "\n".join(self.svg.split("\n")[1:])
-        base64_encoded = (base64.b64encode(svg_without_prolog.encode("utf-8"))
-                .decode("utf-8"))
-        escaped_latex = html.escape(self.latex).replace("\n", "&#13;&#10;")
+        if self._embeddable is None:
+            _, _, svg_without_prolog = self.svg.partition(b"\n")
+            base64_encoded = (base64.b64encode(svg_without_prolog)
+                    .decode("ascii"))
+            escaped_latex = self.latex.translate(__class__._escape_table)
 
-        return " ".join([
-            f'<img style="{self.css()}"',
-            f'alt="{escaped_latex}" title="{escaped_latex}"',
-            f'src="data:image/svg+xml;base64, {base64_encoded}">',
-        ])
+            self._embeddable = (
+                f'<img style="{self.css()}" '
+                f'alt="{escaped_latex}" title="{escaped_latex}" '
+                f'src="data:image/svg+xml;base64, {base64_encoded}">'
+            )
+        return self._embeddable
+
+
+class LatexClippingBatch:
+    """Column-oriented storage for a batch of rendered clippings.
+
+    Instead of one LatexClipping object per clipping, the batch holds
+    one list or array per field, packing the measurements into C float
+    arrays. For corpora of thousands of clippings this cuts the memory
+    of the numeric fields and the number of objects the garbage
+    collector has to track.
+    """
+
+    __slots__ = ("latex", "svg", "width", "height", "depth")
+
+    def __init__(self, clippings):
+        self.latex = [c.latex for c in clippings]
+        self.svg = [c.svg for c in clippings]
+        self.width = array.array("f", (c.width for c in clippings))
+        self.height = array.array("f", (c.height for c in clippings))
+        self.depth = array.array("f", (c.depth for c in clippings))
+
+    @classmethod
+    def render_many(cls, clippings, preamble=LatexFile.default_preamble,
+            force_refresh=False, measure_depth=True):
+        """Render several clippings and pack the results into a batch;
+        see LatexFile.render_many.
+        """
+
+        return cls(LatexFile.render_many(
+                clippings, preamble, force_refresh, measure_depth))
+
+    def __len__(self):
+        return len(self.latex)
+
+    def __getitem__(self, index):
+        """Return one clipping's fields as a lightweight view."""
+
+        return _BatchedClipping(
+            self.latex[index],
+            self.svg[index],
+            self.width[index],
+            self.height[index],
+            self.depth[index],
+        )
+
+
+# Read-only view of one clipping's fields in a LatexClippingBatch.
+_BatchedClipping = collections.namedtuple(
+        "_BatchedClipping", ("latex", "svg", "width", "height", "depth"))
 
 
 class LatexError(Exception):
@@ -279,11 +765,19 @@ class _LatexChunk:
             self.source_start += 1
         self.lines.extend(lines)
 
+        # Cached, since lines is never mutated after construction.
+        self._len = len(self.lines)
+
+        # Joined lines, computed lazily on first stringification.
+        self._str = None
+
     def __len__(self):
-        return len(self.lines)
+        return self._len
 
     def __str__(self):
-        return "\n".join(self.lines)
+        if self._str is None:
+            self._str = "\n".join(self.lines)
+        return self._str
 
 
 class _SVG:
@@ -296,31 +790,372 @@ class _SVG:
         # Height, in px.
         self.height = height
 
-        # SVG data.
+        # SVG data, as bytes.
         self.source = source
 
 
-def _cropped_pdf_page(pdf_path, page):
-    """Extract a page of the specified PDF as an _SVG."""
+def render_files_parallel(specs, max_workers=None):
+    """Render several batches of clippings in parallel, one process
+    per batch. Each spec is a (preamble, clippings) tuple, and the
+    rendered LatexClippings are returned in the same order. pdflatex
+    is CPU-bound and single-threaded, so independent batches scale
+    with the number of cores.
+    """
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers) as executor:
+        return list(executor.map(_render_spec, specs))
+
+
+def _render_spec(spec):
+    """Render one (preamble, clippings) spec in a worker process."""
+
+    preamble, clippings = spec
+    return LatexFile.render_many(clippings, preamble)
+
+
+def _clipping_cache_key(preamble, latex):
+    """Return the cache key for a clipping rendered with the specified
+    preamble.
+    """
+
+    hashed = (preamble + "\0" + latex).encode("utf-8")
+    return hashlib.sha256(hashed).hexdigest()
+
+
+def _load_cached_clipping(clipping):
+    """Populate a LatexClipping from the on-disk cache. Return whether
+    a cached render was found.
+    """
+
+    fields = _memory_cache.get(clipping._cache_key)
+
+    if fields is None:
+        cache_file = _cache_dir / (clipping._cache_key + ".json")
+        try:
+            fields = json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            return False
+        fields["svg"] = fields["svg"].encode("utf-8")
+        _memory_cache[clipping._cache_key] = fields
+
+    clipping.svg = fields["svg"]
+    clipping.width = fields["width"]
+    clipping.height = fields["height"]
+    clipping.depth = fields["depth"]
+    clipping.cached = True
+    return True
+
+
+def _store_cached_clipping(clipping):
+    """Write a freshly rendered LatexClipping to the on-disk cache."""
+
+    _cache_dir.mkdir(parents=True, exist_ok=True)
+
+    fields = {
+        "svg": clipping.svg.decode("utf-8"),
+        "width": clipping.width,
+        "height": clipping.height,
+        "depth": clipping.depth,
+    }
+
+    # Write to a temporary file first, so a concurrent reader never
+    # sees a partially written cache entry.
+    cache_file = _cache_dir / (clipping._cache_key + ".json")
+    temp_file = cache_file.with_suffix(".tmp")
+    temp_file.write_text(json.dumps(fields))
+    os.replace(temp_file, cache_file)
+
+    _memory_cache[clipping._cache_key] = {
+        "svg": clipping.svg,
+        "width": clipping.width,
+        "height": clipping.height,
+        "depth": clipping.depth,
+    }
+
+
+def _store_one_ex(ex_cache_key, one_ex):
+    """Write a freshly measured ex value to the on-disk cache."""
+
+    _ex_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    cache_file = _ex_cache_dir / ex_cache_key
+    temp_file = cache_file.with_suffix(".tmp")
+    temp_file.write_text(repr(one_ex))
+    os.replace(temp_file, cache_file)
+
+
+# Kept as a bytes pattern so the pdfinfo output never needs decoding;
+# float() and int() parse the matched bytes directly.
+_pdfinfo_box_regex = re.compile(b"".join([
+    rb"^Page\s+(?P<page>[0-9]+)\s+MediaBox:",
+    rb"\s+(?P<x1>[0-9.+-]+)\s+(?P<y1>[0-9.+-]+)",
+    rb"\s+(?P<x2>[0-9.+-]+)\s+(?P<y2>[0-9.+-]+)",
+]), re.MULTILINE)
+
+
+def _dvisvgm_pages(dvi_path, page_count):
+    """Convert every page of the specified DVI to an _SVG, cropped to
+    its drawing, with a single dvisvgm invocation.
+    """
+
+    working_dir = dvi_path.parent
 
-    lines = _run_command(
+    _run_command(
         [
-            "inkscape",
+            _dvisvgm_path,
+            "--page=1-",
+            "--no-fonts",
+            "--exact-bbox",
+            "--output=page-%p.svg",
+            str(dvi_path),
+        ],
+        cwd=working_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    # dvisvgm zero-pads %p in the output pattern to the digit width of
+    # the last page number, so the read-back names must match.
+    digits = len(str(page_count))
+
+    # Read the page dimensions from the SVG roots; dvisvgm quotes
+    # attributes with single quotes.
+    pages = []
+    for page in range(1, page_count + 1):
+        source = (working_dir / f"page-{page:0{digits}d}.svg").read_bytes()
+        width = _svg_width_regex.search(source)
+        height = _svg_height_regex.search(source)
+        pages.append(_SVG(
+                float(width.group(1)), float(height.group(1)), source))
+
+    return pages
+
+
+def _extract_all_pages(pdf_path, page_count):
+    """Extract every page of the specified PDF as an _SVG, cropped to
+    its drawing. Pages are converted with one invocation per page, run
+    concurrently; pdfcrop and pdfinfo remain single-pass.
+    """
+
+    if _use_poppler:
+        return _poppler_pages(pdf_path, page_count)
+    return _inkscape_pages(pdf_path, page_count)
+
+
+def _poppler_pages(pdf_path, page_count):
+    """Extract PDF pages as _SVGs using the poppler tools."""
+
+    working_dir = pdf_path.parent
+
+    # Crop every page to its contents in a single pass.
+    cropped_path = working_dir / "cropped.pdf"
+    _run_command(
+        [_pdfcrop_path, "--hires", str(pdf_path), str(cropped_path)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    # The SVG conversions and the page dimension query all only depend
+    # on the cropped PDF, so run them concurrently. The GIL is
+    # released while blocked in subprocess.run, so threads suffice.
+    # pdftocairo's -svg backend writes every selected page into the
+    # one named output file, so each page is converted by its own
+    # invocation with an explicit output name.
+    max_workers = min(page_count + 1, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        pdftocairo_futures = [
+            executor.submit(
+                _run_command,
+                [
+                    _pdftocairo_path,
+                    "-svg",
+                    "-f", str(page),
+                    "-l", str(page),
+                    str(cropped_path),
+                    str(working_dir / f"page-{page}.svg"),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+            for page in range(1, page_count + 1)
+        ]
+
+        # Read the cropped page dimensions in a single pass.
+        pdfinfo_future = executor.submit(
+            _run_command,
+            [
+                _pdfinfo_path,
+                "-f", "1",
+                "-l", str(page_count),
+                "-box",
+                str(cropped_path),
+            ],
+            capture_output=True,
+            check=True,
+        )
+
+        for future in pdftocairo_futures:
+            future.result()
+        pdfinfo_process = pdfinfo_future.result()
+
+    dimensions = {}
+    for match in _pdfinfo_box_regex.finditer(pdfinfo_process.stdout):
+        width = float(match["x2"]) - float(match["x1"])
+        height = float(match["y2"]) - float(match["y1"])
+        dimensions[int(match["page"])] = (width, height)
+
+    pages = []
+    for page in range(1, page_count + 1):
+        svg_file = working_dir / f"page-{page}.svg"
+        width, height = dimensions[page]
+        pages.append(_SVG(width, height, svg_file.read_bytes()))
+
+    return pages
+
+
+def _marker_depth(image):
+    """Locate the baseline marker in a rendered page and remove it.
+    Return the clipping's depth, in the same units as the page height,
+    and the SVG source without the marker element.
+
+    If the marker cannot be found (e.g. the converter merged it into
+    another element), the depth falls back to zero.
+    """
+
+    source = image.source
+
+    marker = _marker_element_regex.search(source)
+    if marker is None:
+        return 0.0, source
+
+    element = marker.group(0)
+
+    # Bottom edge of the marker, in user units. Rect elements carry y
+    # and height attributes; path elements alternate x and y
+    # coordinates in their outline data.
+    y_attr = _y_attr_regex.search(element)
+    height_attr = _height_attr_regex.search(element)
+    if y_attr and height_attr:
+        bottom = float(y_attr.group(1)) + float(height_attr.group(1))
+    else:
+        outline = _outline_attr_regex.search(element)
+        if outline is None:
+            return 0.0, source
+        coordinates = _number_regex.findall(outline.group(1))
+        if len(coordinates) < 2:
+            return 0.0, source
+        bottom = max(float(c) for c in coordinates[1::2])
+
+    # Convert from user units to the page height units via the viewBox.
+    view_box = _svg_view_box_regex.search(source)
+    if view_box:
+        box_y, box_height = (float(f) for f in view_box.group(1).split()[1::2])
+    else:
+        box_y = 0.0
+        box_height = image.height
+
+    depth = (box_y + box_height - bottom) / box_height * image.height
+
+    # The marker sits on the baseline, so anything below it belongs to
+    # the clipping; tiny negative values are just rounding.
+    depth = max(depth, 0.0)
+
+    source = source[:marker.start()] + source[marker.end():]
+    return depth, source
+
+
+def _inkscape_pages(pdf_path, page_count):
+    """Extract PDF pages as _SVGs with inkscape, one invocation per
+    page, run concurrently. Inkscape's shell-mode action lists have no
+    way to select a PDF page (--pdf-page is only a command-line
+    option), so the per-page startup cost is hidden with parallelism
+    instead of a shared session.
+    """
+
+    working_dir = pdf_path.parent
+
+    svg_files = []
+    commands = []
+    for page in range(1, page_count + 1):
+        svg_file = working_dir / f"page-{page}.svg"
+        svg_files.append(svg_file)
+        commands.append([
+            _inkscape_path,
             "--pdf-poppler",
             f"--pdf-page={page}",
-            "--query-width",
-            "--query-height",
-            "--export-plain-svg",
             "--export-area-drawing",
-            "--export-filename=-",
-            shlex.quote(str(pdf_path))
-        ],
-        text=True,
-        capture_output=True,
-        check=True,
-    ).stdout.split("\n")
+            "--export-plain-svg",
+            f"--export-filename={svg_file}",
+            str(pdf_path),
+        ])
+
+    max_workers = min(page_count, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _run_command,
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+            for command in commands
+        ]
+        for future in futures:
+            future.result()
+
+    # Read the drawing dimensions from the exported SVG roots, rather
+    # than re-spawning inkscape for --query-width/--query-height.
+    pages = []
+    for svg_file in svg_files:
+        source = svg_file.read_bytes()
+        width = _svg_width_regex.search(source)
+        height = _svg_height_regex.search(source)
+        pages.append(_SVG(
+                float(width.group(1)), float(height.group(1)), source))
+
+    return pages
+
+
+@functools.lru_cache(maxsize=None)
+def _engine_version(engine_path):
+    """Return the first line of the engine's --version output, as
+    bytes. Used to key cached format files, since an engine refuses to
+    load a format dumped by a different version.
+    """
+
+    try:
+        version_process = _run_command(
+                [engine_path, "--version"], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return b"unknown"
+    return version_process.stdout.partition(b"\n")[0]
+
+
+def _render_dir():
+    """Return a fresh working directory for one render, as a
+    subdirectory of a per-process temporary root. The root is created
+    once and removed at interpreter exit; the subdirectory is removed
+    by the caller when the render finishes.
+    """
 
-    return _SVG(float(lines[0]), float(lines[1]), "\n".join(lines[2:]))
+    global _temp_root
+    if _temp_root is None:
+        # Prefer a RAM-backed root, so the auxiliary files never touch
+        # the disk.
+        parent = "/dev/shm" if Path("/dev/shm").is_dir() else None
+        _temp_root = tempfile.mkdtemp(prefix="latexclippings-", dir=parent)
+        atexit.register(shutil.rmtree, _temp_root, ignore_errors=True)
+
+    render_dir = Path(_temp_root) / uuid.uuid4().hex
+    render_dir.mkdir()
+    return render_dir
 
 
 def _run_command(command, **kwargs):
@@ -365,9 +1200,8 @@ def _main():
             with open(path) as f:
                 clippings.append(f.read())
 
-    latex_file = LatexFile(clippings, preamble)
     try:
-        latex_file.render()
+        rendered = LatexFile.render_many(clippings, preamble)
     except LatexError as e:
         if e.clipping_index is not None:
             e.location += f" (input file '{args.file[e.clipping_index]}')"
@@ -376,19 +1210,19 @@ def _main():
         _die(e)
 
     if args.format == "html":
-        outputs = [c.embeddable() for c in latex_file.clippings]
+        outputs = [c.embeddable().encode("utf-8") for c in rendered]
     elif args.format == "svg":
-        outputs = [c.svg for c in latex_file.clippings]
+        outputs = [c.svg for c in rendered]
 
     for path, output in zip(args.file, outputs):
         if path == "-":
             log("Output: stdout")
-            sys.stdout.write(output)
+            sys.stdout.buffer.write(output)
         else:
             path = Path(path)
             path = path.parent / (path.stem + "." + args.format)
             log(f"Output: '{path}'")
-            with open(path, "w") as f:
+            with open(path, "wb") as f:
                 f.write(output)
 
 